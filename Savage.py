@@ -1,102 +1,211 @@
+import gc
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from io import BytesIO
+
 import streamlit as st
 import pandas as pd
-from io import BytesIO
+import numpy as np
 
 # ----------------------------
 # Helper utilities
 # ----------------------------
-def excel_to_bytes(df: pd.DataFrame, sheet_name: str = "Sheet1"):
-    """Return bytes buffer of an Excel file for download."""
+XLS_MAGIC = b"\xd0\xcf\x11\xe0"  # legacy .xls is an OLE2 compound file; .xlsx is a zip
+_HDR_RE = re.compile(r'[\n"]+')
+
+def clean_header(col) -> str:
+    """Collapse newlines/quotes in a header cell to spaces and trim it."""
+    return _HDR_RE.sub(" ", str(col)).strip()
+
+def is_sum_column(col) -> bool:
+    """True for "Sum ..." subtotal headers; date or numeric headers never match."""
+    return isinstance(col, str) and col.lower().startswith("sum")
+
+@contextmanager
+def upload_path(file_bytes: bytes):
+    """Spill uploaded bytes to a temporary file and yield its path.
+
+    Readers given a path stream the workbook from disk instead of holding
+    another in-memory copy of the upload. The file is removed on exit.
+    """
+    suffix = ".xls" if file_bytes[:4] == XLS_MAGIC else ".xlsx"
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        tmp.write(file_bytes)
+    try:
+        yield tmp.name
+    finally:
+        os.unlink(tmp.name)
+
+def blank_numeric_zeros(df: pd.DataFrame) -> pd.DataFrame:
+    """Return a copy of df with zeros in numeric columns made missing (written as empty)."""
+    df = df.copy()
+    for c in df.select_dtypes("number").columns:
+        # nullable Int64 keeps integer counts as integers once zeros become missing
+        col = df[c].astype("Int64") if pd.api.types.is_integer_dtype(df[c]) else df[c]
+        df[c] = col.mask(col == 0)
+    return df
+
+def excel_to_bytes(df: pd.DataFrame, sheet_name: str = "Sheet1") -> bytes:
+    """Return the bytes of an Excel file for download."""
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
         df.to_excel(writer, index=False, sheet_name=sheet_name)
-    output.seek(0)
-    return output
+    return output.getvalue()
+
+DOWNLOAD_MIME = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def table_to_bytes(df: pd.DataFrame, fmt: str = "xlsx", sheet_name: str = "Sheet1",
+                   blank_zeros: bool = False) -> bytes:
+    """Serialise df as xlsx, csv or parquet for download, cached on its contents.
+
+    blank_zeros leaves numeric zeros empty in every format.
+    """
+    if blank_zeros:
+        df = blank_numeric_zeros(df)
+    if fmt == "xlsx":
+        return excel_to_bytes(df, sheet_name=sheet_name)
+    output = BytesIO()
+    if fmt == "csv":
+        df.to_csv(output, index=False)
+    else:
+        # parquet needs text headers and single-type columns (PLM mixes "" with numbers)
+        obj_cols = df.select_dtypes("object").columns
+        df = df.astype({c: "string" for c in obj_cols}).rename(columns=str)
+        df.to_parquet(output, engine="pyarrow", compression="zstd", index=False)
+    return output.getvalue()
+
+def download_table(df: pd.DataFrame, label: str, file_stem: str, sheet_name: str, key: str,
+                   blank_zeros: bool = False):
+    """Render a download-format picker and the matching download button."""
+    fmt = st.radio("Download format", list(DOWNLOAD_MIME), horizontal=True, key=f"{key}_fmt")
+    data = table_to_bytes(df, fmt, sheet_name=sheet_name, blank_zeros=blank_zeros)
+    st.download_button(label, data, file_name=f"{file_stem}.{fmt}", mime=DOWNLOAD_MIME[fmt])
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def read_workbook(file_bytes: bytes, sheet_names=None, columns=None, **read_kwargs) -> dict:
+    """Parse an uploaded workbook once, cached on its contents.
+
+    Returns {sheet name: DataFrame} for the listed sheets that exist, or for
+    the first sheet when sheet_names is None. With columns, only headers whose
+    clean_header() form is listed are materialised.
+    """
+    if columns is not None:
+        wanted_cols = frozenset(columns)
+        read_kwargs["usecols"] = lambda c: clean_header(c) in wanted_cols
+    with upload_path(file_bytes) as path, pd.ExcelFile(path, engine="calamine") as xls:
+        if sheet_names is None:
+            wanted = xls.sheet_names[:1]
+        else:
+            available = set(xls.sheet_names)
+            wanted = [s for s in sheet_names if s in available]
+        if not wanted:
+            return {}
+        return pd.read_excel(xls, sheet_name=wanted, **read_kwargs)
+
+def read_excel_bytes(file_bytes: bytes, **read_kwargs) -> pd.DataFrame:
+    """Return the first sheet of an uploaded workbook."""
+    return next(iter(read_workbook(file_bytes, **read_kwargs).values()))
+
+def parse_excel_dates(values: pd.Series, dayfirst: bool = False) -> pd.Series:
+    """Parse a date column once, reading numeric columns as Excel serial days."""
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_datetime(values, errors="coerce", unit="D", origin="1899-12-30")
+    return pd.to_datetime(values, errors="coerce", dayfirst=dayfirst)
+
+def month_codes(dates: pd.Series) -> np.ndarray:
+    """Return 0-based month numbers (int8) for a datetime Series, -1 where NaT."""
+    values = dates.to_numpy()  # keep the parsed resolution; [M] casts from any unit
+    months = values.astype("datetime64[M]").view(np.int64) % 12
+    return np.where(np.isnat(values), -1, months).astype(np.int8)
 
 # ----------------------------
 # SAVAGE logic
 # ----------------------------
-def transform_style_units(uploaded_file):
-    df = pd.read_excel(uploaded_file, header=2)
-    df.columns = df.columns.str.replace(r'[\n"]+', ' ', regex=True).str.strip()
+MONTH_ORDER = ["JAN", "FEB", "MAR", "APR", "MAY", "JUNE",
+               "JULY", "AUG", "SEP", "OCT", "NOV", "DEC"]
+BUY_REQUIRED_COLS = ("DESIGN STYLE", "XFD", "GLOBAL UNITS")
+
+def transform_style_units(df: pd.DataFrame):
+    df.columns = [clean_header(c) for c in df.columns]
 
-    required = ["DESIGN STYLE", "XFD", "GLOBAL UNITS"]
-    missing = [c for c in required if c not in df.columns]
+    missing = [c for c in BUY_REQUIRED_COLS if c not in df.columns]
     if missing:
         raise ValueError(f"Missing required columns for Savage Buy file: {missing}")
 
-    df = df[required].copy()
-    df["XFD_dt"] = pd.to_datetime(df["XFD"], errors="coerce", dayfirst=True)
-    if df["XFD_dt"].isna().all() and pd.api.types.is_numeric_dtype(df["XFD"]):
-        df["XFD_dt"] = pd.to_datetime(df["XFD"], errors="coerce", unit="D", origin="1899-12-30")
-
-    month_map = {1:"JAN",2:"FEB",3:"MAR",4:"APR",5:"MAY",6:"JUNE",
-                 7:"JULY",8:"AUG",9:"SEP",10:"OCT",11:"NOV",12:"DEC"}
-    df["MONTH"] = df["XFD_dt"].dt.month.map(month_map)
-    df = df[df["MONTH"].notna()]
-
-    pivot_df = df.pivot_table(
-        index="DESIGN STYLE",
-        columns="MONTH",
-        values="GLOBAL UNITS",
-        aggfunc="sum",
-        fill_value=0
-    ).reset_index()
-
-    month_order = ["JAN","FEB","MAR","APR","MAY","JUNE","JULY","AUG","SEP","OCT","NOV","DEC"]
-    non_month_cols = [c for c in pivot_df.columns if c not in month_order]
-    ordered_cols = non_month_cols + [m for m in month_order if m in pivot_df.columns]
-    pivot_df = pivot_df[ordered_cols]
+    xfd_dt = parse_excel_dates(df["XFD"], dayfirst=True)
+
+    # code -1 (unparseable date) becomes a NaN category and is dropped by groupby
+    units = pd.DataFrame({
+        "DESIGN STYLE": df["DESIGN STYLE"].to_numpy(),
+        "MONTH": pd.Categorical.from_codes(month_codes(xfd_dt), categories=MONTH_ORDER, ordered=True),
+        "GLOBAL UNITS": df["GLOBAL UNITS"].to_numpy(),
+    })
+
+    pivot_df = (
+        units.groupby(["DESIGN STYLE", "MONTH"], observed=True)["GLOBAL UNITS"]
+        .sum()
+        .unstack("MONTH", fill_value=0)
+        .reset_index()
+    )
     return pivot_df
 
 
-def transform_plm_to_mcu(uploaded_file):
-    expected_sheet_names = [
-        "Fabrics", "Strip Cut", "Laces", "Embriodery/Printing",
-        "Elastics", "Tapes", "Trim/Component", "Label/ Transfer",
-        "Foam Cup", "Packing Trim"
-    ]
-    base_cols = [
-        "Sheet Names", "Season", "Style", "BOM", "Cycle", "Article",
-        "Type of Const 1", "Supplier", "UOM", "Composition",
-        "Measurement", "Supplier Country", "Avg YY"
-    ]
-    xls = pd.ExcelFile(uploaded_file)
+PLM_SHEET_NAMES = [
+    "Fabrics", "Strip Cut", "Laces", "Embriodery/Printing",
+    "Elastics", "Tapes", "Trim/Component", "Label/ Transfer",
+    "Foam Cup", "Packing Trim"
+]
+PLM_BASE_COLS = [
+    "Sheet Names", "Season", "Style", "BOM", "Cycle", "Article",
+    "Type of Const 1", "Supplier", "UOM", "Composition",
+    "Measurement", "Supplier Country", "Avg YY"
+]
+PLM_BASE_COLS_SET = frozenset(PLM_BASE_COLS)
+
+def transform_plm_to_mcu(sheets: dict):
     collected = []
 
-    for sheet in expected_sheet_names:
-        if sheet in xls.sheet_names:
-            df = pd.read_excel(xls, sheet_name=sheet)
-            df.columns = df.columns.str.strip()
-            mask_keep = ~df.columns.str.strip().str.lower().str.startswith("sum")
-            df = df.loc[:, mask_keep]
-            df.insert(0, "Sheet Names", sheet)
-            for col in base_cols:
-                if col not in df.columns:
-                    df[col] = ""
-            dynamic_cols = [c for c in df.columns if c not in base_cols]
-            keep_cols = base_cols + dynamic_cols
-            df = df.loc[:, keep_cols]
-            collected.append(df)
+    for sheet, df in sheets.items():
+        df.columns = [c.strip() if isinstance(c, str) else c for c in df.columns]
+        # "Season" and "Season " collide once stripped; keep the first so reindex stays valid
+        df = df.loc[:, ~df.columns.duplicated()]
+        cols = list(df.columns)
+        dynamic_cols = [c for c in cols if c not in PLM_BASE_COLS_SET and not is_sum_column(c)]
+        # one reindex drops "Sum" columns and adds any missing base columns as ""
+        df = df.reindex(columns=PLM_BASE_COLS + dynamic_cols, fill_value="")
+        df["Sheet Names"] = sheet
+        collected.append(df)
 
     if not collected:
-        return pd.DataFrame(columns=base_cols)
+        return pd.DataFrame(columns=PLM_BASE_COLS)
 
+    # every sheet starts with PLM_BASE_COLS, so the union keeps them first
+    all_cols = list(dict.fromkeys(c for df in collected for c in df.columns))
+    collected = [df.reindex(columns=all_cols) for df in collected]
     combined = pd.concat(collected, ignore_index=True)
-    dynamic_cols = [c for c in combined.columns if c not in base_cols]
-    final_cols = base_cols + dynamic_cols
-    combined = combined.loc[:, final_cols]
     return combined
 
 # ----------------------------
 # VSPINK logic
 # ----------------------------
 def transform_vspink_data(df):
-    df.columns = df.columns.str.strip().str.replace("\n", " ").str.replace("\r", " ")
-
-    exmill_col = [c for c in df.columns if "ex-mill" in c.lower()][0]
-    qty_col = [c for c in df.columns if "qty" in c.lower()][0]
-    article_col = [c for c in df.columns if "article" in c.lower()][0]
+    df.columns = [str(c).strip().replace("\n", " ").replace("\r", " ") for c in df.columns]
+
+    lowered = [(c.lower(), c) for c in df.columns]
+    exmill_col = next((c for low, c in lowered if "ex-mill" in low), None)
+    qty_col = next((c for low, c in lowered if "qty" in low), None)
+    article_col = next((c for low, c in lowered if "article" in low), None)
+    missing = [name for name, col in [("EX-mill", exmill_col), ("Qty", qty_col), ("Article", article_col)]
+               if col is None]
+    if missing:
+        raise ValueError(f"Missing required columns for VSPINK file: {missing}")
 
     metadata_cols = [
         "Customer", "Supplier", "Supplier COO", "Production Plant (region)",
@@ -106,30 +215,26 @@ def transform_vspink_data(df):
     ]
     metadata_cols = [c for c in metadata_cols if c in df.columns]
 
-    df["EX-mill_dt"] = pd.to_datetime(df[exmill_col], errors="coerce")
-    df["Month-Year"] = df["EX-mill_dt"].dt.strftime("%b-%y")
+    month_year = parse_excel_dates(df[exmill_col]).dt.to_period("M").rename("Month-Year")
 
-    df[qty_col] = (
-        df[qty_col].astype(str).str.replace(",", "", regex=False).str.strip()
-    )
-    df[qty_col] = pd.to_numeric(df[qty_col], errors="coerce").fillna(0)
-
-    grouped = df.groupby([article_col, "Month-Year"], as_index=False)[qty_col].sum()
-
-    pivot_df = grouped.pivot_table(
-        index=article_col,
-        columns="Month-Year",
-        values=qty_col,
-        aggfunc="sum",
-        fill_value=0
-    ).reset_index()
+    qty = df[qty_col]
+    if not pd.api.types.is_numeric_dtype(qty):
+        qty = qty.astype(str).str.replace(",", "", regex=False).str.strip()
+    qty = pd.to_numeric(qty, errors="coerce").fillna(0)
 
-    parsed_months = pd.to_datetime(pivot_df.columns[1:], format="%b-%y", errors="coerce")
-    month_order = parsed_months.sort_values().strftime("%b-%y").tolist()
-    pivot_df = pivot_df[[article_col] + month_order]
+    pivot_df = (
+        qty.groupby([df[article_col], month_year], observed=True, sort=False)
+        .sum()
+        .unstack("Month-Year", fill_value=0)
+        .sort_index(axis=1)
+    )
+    # periods sort chronologically; only the final headers are formatted as text
+    pivot_df.columns = pivot_df.columns.strftime("%b-%y")
+    pivot_df = pivot_df.reset_index()
 
+    # first() takes the first non-blank value per column and orders mixed-type keys safely
     meta = df.groupby(article_col, as_index=False)[metadata_cols].first()
-    final_df = pd.merge(meta, pivot_df, on=article_col, how="left")
+    final_df = meta.merge(pivot_df, on=article_col, how="left", sort=False)
 
     return final_df
 
@@ -144,8 +249,9 @@ def transform_hugoboss_buy_to_plm(df):
     return final_df
 
 def transform_hugoboss_plm_to_mcu(df):
-    df.columns = df.columns.str.strip()
-    mask_keep = ~df.columns.str.lower().str.startswith("sum")
+    cols = [c.strip() if isinstance(c, str) else c for c in df.columns]
+    df.columns = cols
+    mask_keep = [not is_sum_column(c) for c in cols]
     df = df.loc[:, mask_keep]
     return df
 
@@ -172,13 +278,12 @@ def page_savage():
     buy_file = st.file_uploader("Upload Buy file (Savage)", type=["xlsx","xls"], key="buy_file")
     if buy_file:
         try:
-            df_out = transform_style_units(buy_file)
+            buy_df = read_excel_bytes(buy_file.getvalue(), header=2, columns=BUY_REQUIRED_COLS)
+            df_out = transform_style_units(buy_df)
             st.subheader("Preview — PLM Upload")
             st.dataframe(df_out.head())
-            out_bytes = excel_to_bytes(df_out, sheet_name="PLM Upload")
-            st.download_button("📥 Download PLM Upload - savage.xlsx", out_bytes,
-                               file_name="plm_upload_savage.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            download_table(df_out, "📥 Download PLM Upload - savage", "plm_upload_savage",
+                           sheet_name="PLM Upload", key="buy_file", blank_zeros=True)
         except Exception as e:
             st.error(f"Error processing buy file: {e}")
 
@@ -187,13 +292,15 @@ def page_savage():
     plm_file = st.file_uploader("Upload PLM Download file (Savage)", type=["xlsx","xls"], key="plm_file")
     if plm_file:
         try:
-            mcu = transform_plm_to_mcu(plm_file)
+            sheets = read_workbook(plm_file.getvalue(), tuple(PLM_SHEET_NAMES))
+            mcu = transform_plm_to_mcu(sheets)
+            # the per-sheet frames are dead once combined; release them before rendering
+            del sheets
+            gc.collect()
             st.subheader("Preview — MCU Combined")
             st.dataframe(mcu.head())
-            out_bytes = excel_to_bytes(mcu, sheet_name="MCU")
-            st.download_button("📥 Download MCU - savage.xlsx", out_bytes,
-                               file_name="MCU_savage.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            download_table(mcu, "📥 Download MCU - savage", "MCU_savage",
+                           sheet_name="MCU", key="plm_file")
         except Exception as e:
             st.error(f"Error processing PLM download file: {e}")
 
@@ -203,14 +310,12 @@ def page_hugoboss():
     buy_file = st.file_uploader("Upload Buy Sheet (HugoBoss)", type=["xlsx","xls"], key="hb_buy")
     if buy_file:
         try:
-            df = pd.read_excel(buy_file)
+            df = read_excel_bytes(buy_file.getvalue())
             df_out = transform_hugoboss_buy_to_plm(df)
             st.subheader("Preview — PLM Download")
             st.dataframe(df_out.head())
-            out_bytes = excel_to_bytes(df_out, sheet_name="PLM Download")
-            st.download_button("📥 Download PLM Download - hugoboss.xlsx", out_bytes,
-                               file_name="plm_download_hugoboss.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            download_table(df_out, "📥 Download PLM Download - hugoboss", "plm_download_hugoboss",
+                           sheet_name="PLM Download", key="hb_buy")
         except Exception as e:
             st.error(f"Error processing HugoBoss Buy file: {e}")
 
@@ -219,14 +324,12 @@ def page_hugoboss():
     plm_file = st.file_uploader("Upload PLM Upload file (HugoBoss)", type=["xlsx","xls"], key="hb_plm")
     if plm_file:
         try:
-            df = pd.read_excel(plm_file)
+            df = read_excel_bytes(plm_file.getvalue())
             df_out = transform_hugoboss_plm_to_mcu(df)
             st.subheader("Preview — MCU")
             st.dataframe(df_out.head())
-            out_bytes = excel_to_bytes(df_out, sheet_name="MCU")
-            st.download_button("📥 Download MCU - hugoboss.xlsx", out_bytes,
-                               file_name="MCU_hugoboss.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            download_table(df_out, "📥 Download MCU - hugoboss", "MCU_hugoboss",
+                           sheet_name="MCU", key="hb_plm")
         except Exception as e:
             st.error(f"Error processing HugoBoss PLM upload: {e}")
 
@@ -236,14 +339,12 @@ def page_vspink():
     up = st.file_uploader("Upload VSPINK file", type=["xlsx","xls"], key="vspink_file")
     if up:
         try:
-            df = pd.read_excel(up)
+            df = read_excel_bytes(up.getvalue())
             df_v = transform_vspink_data(df)
             st.subheader("Preview — VSPINK MCU")
             st.dataframe(df_v.head())
-            out_bytes = excel_to_bytes(df_v, sheet_name="VSPINK MCU")
-            st.download_button("📥 Download VSPINK MCU", out_bytes,
-                               file_name="vspink_mcu.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            download_table(df_v, "📥 Download VSPINK MCU", "vspink_mcu",
+                           sheet_name="VSPINK MCU", key="vspink_file")
         except Exception as e:
             st.error(f"Error processing VSPINK file: {e}")
 